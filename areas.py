@@ -0,0 +1,154 @@
+import logging
+from dataclasses import dataclass, replace
+from utils import SVY21
+from config import AREA_CELL_SIZES_M
+
+logger = logging.getLogger(__name__)
+
+# cell size -> (easting index, northing index) -> AreaSummary
+# Handlers read this on other threads, so it is never changed in place: updates build
+# new cell dicts and summaries and swap them in with a single assignment.
+AREAS = {size: {} for size in AREA_CELL_SIZES_M}
+
+# carpark id -> (position, (easting, northing)), so each position is only projected once
+_PROJECTIONS = {}
+
+DIRECTIONS = {
+    (0, 0): "Here",
+    (0, 1): "North",
+    (1, 1): "North-east",
+    (1, 0): "East",
+    (1, -1): "South-east",
+    (0, -1): "South",
+    (-1, -1): "South-west",
+    (-1, 0): "West",
+    (-1, 1): "North-west",
+}
+
+
+@dataclass
+class AreaSummary:
+    total_lots: int = 0  # only from carparks that report a total
+    available_lots: int = 0
+    carparks: int = 0
+    carparks_without_total: int = 0  # e.g. malls from LTA, which only report available lots
+
+    def has_complete_total(self):
+        return self.carparks_without_total == 0
+
+    def is_consistent(self):
+        if self.carparks == 0:
+            return self.total_lots == self.available_lots == self.carparks_without_total == 0
+        return min(self.total_lots, self.available_lots, self.carparks, self.carparks_without_total) >= 0
+
+
+def project(position):
+    northing, easting = SVY21.computeSVY21(position.latitude, position.longitude)
+    return easting, northing
+
+
+def _carpark_coordinates(carpark):
+    cached = _PROJECTIONS.get(carpark.id)
+    if cached is None or cached[0] != carpark.position:
+        cached = (carpark.position, project(carpark.position))
+        _PROJECTIONS[carpark.id] = cached
+    return cached[1]
+
+
+def cell_for(coordinates, size):
+    easting, northing = coordinates
+    return int(easting // size), int(northing // size)
+
+
+def _apply(areas, fresh, carpark, sign):
+    """Add (sign 1) or remove (sign -1) a carpark from its cells in areas. Summaries
+    whose (size, cell) is not in fresh may still be published, so they are copied
+    before being changed. Returns False if a cell ended up inconsistent."""
+    coordinates = _carpark_coordinates(carpark)
+    consistent = True
+    for size, cells in areas.items():
+        cell = cell_for(coordinates, size)
+        if (size, cell) not in fresh:
+            summary = cells.get(cell)
+            cells[cell] = replace(summary) if summary is not None else AreaSummary()
+            fresh.add((size, cell))
+        summary = cells[cell]
+        summary.available_lots += sign * (carpark.available_lots or 0)
+        summary.carparks += sign
+        if carpark.total_lots:
+            summary.total_lots += sign * carpark.total_lots
+        else:
+            summary.carparks_without_total += sign
+        consistent = consistent and summary.is_consistent()
+        if summary.carparks == 0:
+            del cells[cell]
+            fresh.discard((size, cell))
+    return consistent
+
+
+def _unchanged(before, after):
+    return (before.position == after.position and before.total_lots == after.total_lots
+            and before.available_lots == after.available_lots)
+
+
+def rebuild_areas(carparks):
+    """Recompute every area summary from scratch."""
+    global AREAS
+    areas = {size: {} for size in AREA_CELL_SIZES_M}
+    fresh = set()
+    for carpark in carparks.values():
+        if carpark.is_valid():
+            _apply(areas, fresh, carpark, 1)
+    AREAS = areas
+    logger.info(f"Area summaries rebuilt from {len(carparks)} carparks")
+
+
+def update_areas(old_carparks, new_carparks):
+    """Apply the difference between two snapshots to the area summaries,
+    touching only the cells of carparks that changed. Falls back to a full
+    rebuild if the summaries turn out not to match old_carparks."""
+    global AREAS
+    areas = {size: dict(cells) for size, cells in AREAS.items()}
+    fresh = set()
+    changed = 0
+    consistent = True
+    try:
+        for carpark_id in old_carparks.keys() | new_carparks.keys():
+            before = old_carparks.get(carpark_id)
+            after = new_carparks.get(carpark_id)
+            before = before if before is not None and before.is_valid() else None
+            after = after if after is not None and after.is_valid() else None
+            if before is None and after is None:
+                continue
+            if before is not None and after is not None and _unchanged(before, after):
+                continue
+            if before is not None:
+                consistent = _apply(areas, fresh, before, -1) and consistent
+            if after is not None:
+                consistent = _apply(areas, fresh, after, 1) and consistent
+            changed += 1
+    except Exception as e:
+        logger.error(f"Updating area summaries failed: {e}")
+        consistent = False
+    if not consistent:
+        rebuild_areas(new_carparks)
+        return
+    AREAS = areas
+    logger.info(f"{changed} carparks changed, area summaries updated")
+
+
+def get_area_summary(position, size):
+    return AREAS[size].get(cell_for(project(position), size))
+
+
+def get_neighbouring_areas(position, size):
+    """Summaries of the cell containing position and its eight neighbours,
+    as a list of (direction, summary) for the cells that have carparks."""
+    centre_e, centre_n = cell_for(project(position), size)
+    cells = AREAS[size]
+    result = []
+    for (dx, dy), direction in DIRECTIONS.items():
+        summary = cells.get((centre_e + dx, centre_n + dy))
+        if summary is not None:
+            result.append((direction, summary))
+    return result
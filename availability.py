@@ -4,15 +4,24 @@ import csv
 import os.path
 import logging
 import math
+import hashlib
+import threading
 from dataclasses import dataclass
+from datetime import datetime
 import googlemaps
 from utils import haversine, SVY21
+from areas import update_areas
 from secret import DATAMALL_APIKEY, GOOGLE_MAPS_APIKEY
 from config import DATA_FOLDER
 
 logger = logging.getLogger(__name__)
 
 CARPARKS = {}
+# held while writing the latest availability files and while rebuilding and swapping CARPARKS
+REFRESH_LOCK = threading.Lock()
+SNAPSHOT_VERSION = 0  # bumped whenever CARPARKS is rebuilt
+CATALOGUE = None  # (static file mtimes, carpark id -> Carpark keyword arguments)
+CATALOGUE_VERSION = 0  # bumped whenever the static files are parsed
 
 
 @dataclass
@@ -52,6 +61,12 @@ class Page:
         return int(math.ceil(self.start / interval)) + 1
 
 
+@dataclass
+class SourceUpdate:
+    version: str  # changes whenever the upstream source publishes new data
+    published_at: float = None  # epoch seconds reported by the source, if it reports one
+
+
 @dataclass
 class Position:
     latitude: float
@@ -87,10 +102,19 @@ class Carpark:
     gantry_height: float = None
     car_park_basement: bool = None
 
+    snapshot: int = None  # SNAPSHOT_VERSION of the refresh that built this object
+    catalogue: int = None  # CATALOGUE_VERSION of the static data this object was built from
+
     def is_valid(self):
         return self.position is not None and self.address is not None
 
 
+@dataclass
+class CarparkResult:
+    carpark: Carpark
+    distance: float = None  # km from the queried position, None if no position was given
+
+
 def fetch_carpark_avail_datagov(overwrite=True):
     r = requests.get(
         "https://api.data.gov.sg/v1/transport/carpark-availability")
@@ -99,8 +123,10 @@ def fetch_carpark_avail_datagov(overwrite=True):
     filename = os.path.join(DATA_FOLDER, "avail", "avail_datagov_{}.json".format(timestamp))
 
     logger.debug("retrieved {} objects from data.gov.sg".format(len(response['items'][0]['carpark_data'])))
-    with open(filename, 'w') as outfile:
+    with REFRESH_LOCK, open(filename, 'w') as outfile:
         json.dump(response['items'][0], outfile)
+    published_at = datetime.fromisoformat(response['items'][0]['timestamp']).timestamp()
+    return SourceUpdate(response['items'][0]['timestamp'], published_at)
 
 
 def fetch_carpark_avail_lta(overwrite=True):
@@ -122,34 +148,57 @@ def fetch_carpark_avail_lta(overwrite=True):
     timestamp = "latest" if overwrite else ""
     filename = os.path.join(DATA_FOLDER, "avail", "avail_lta_{}.json".format(timestamp))
     logger.debug("retrieved {} objects from LTA datamall".format(len(result)))
-    with open(filename, 'w') as outfile:
+    with REFRESH_LOCK, open(filename, 'w') as outfile:
         json.dump(result, outfile)
+    # datamall does not report when the data was published, so the content itself is the version
+    return SourceUpdate(hashlib.md5(json.dumps(result, sort_keys=True).encode()).hexdigest())
 
 
-def fetch_carpark_avail_all(overwrite=True):
-    logger.debug("Fetch carpark availability...")
-    fetch_carpark_avail_datagov(overwrite)
-    fetch_carpark_avail_lta(overwrite)
-    global CARPARKS
-    CARPARKS = combine_availabilities_and_static_data()
+FETCHERS = {
+    "datagov": fetch_carpark_avail_datagov,
+    "lta": fetch_carpark_avail_lta,
+}
 
 
-def combine_availabilities_and_static_data():
-    with open(os.path.join(DATA_FOLDER, "hdb-carpark-information.csv")) as f:
+def refresh_carparks():
+    global CARPARKS, SNAPSHOT_VERSION
+    with REFRESH_LOCK:
+        carparks = combine_availabilities_and_static_data()
+        SNAPSHOT_VERSION += 1
+        for carpark in carparks.values():
+            carpark.snapshot = SNAPSHOT_VERSION
+        update_areas(CARPARKS, carparks)
+        CARPARKS = carparks
+
+
+def fetch_carpark_avail_all(overwrite=True):
+    logger.debug("Fetch carpark availability...")
+    for fetch in FETCHERS.values():
+        fetch(overwrite)
+    refresh_carparks()
+
+
+def load_catalogue():
+    """Parse the static carpark files into Carpark keyword arguments, reusing the
+    previous parse until one of the files is modified."""
+    global CATALOGUE, CATALOGUE_VERSION
+    hdb_file = os.path.join(DATA_FOLDER, "hdb-carpark-information.csv")
+    lta_file = os.path.join(DATA_FOLDER, "carpark-rates.csv")
+    mtimes = (os.path.getmtime(hdb_file), os.path.getmtime(lta_file))
+    if CATALOGUE is not None and CATALOGUE[0] == mtimes:
+        return CATALOGUE[1]
+
+    with open(hdb_file) as f:
         reader = csv.DictReader(f)
         carpark_static_hdb = list(reader)
-    with open(os.path.join(DATA_FOLDER, "carpark-rates.csv")) as f:
+    with open(lta_file) as f:
         reader = csv.DictReader(f)
         carpark_static_lta = list(reader)
-    with open(os.path.join(DATA_FOLDER, "avail/avail_datagov_latest.json")) as f:
-        latest_avail_hdb = json.load(f)['carpark_data']
-    with open(os.path.join(DATA_FOLDER, "avail/avail_lta_latest.json")) as f:
-        latest_avail_lta = json.load(f)
 
-    carparks = {}
+    catalogue = {}
     for carpark in carpark_static_hdb:
         lat, lon = SVY21.computeLatLon(float(carpark['x_coord']), float(carpark['y_coord']))
-        cp = Carpark(
+        catalogue[carpark['car_park_no']] = dict(
             id=carpark['car_park_no'].upper(),
             position=Position(lat, lon),
             address=carpark['address'],
@@ -164,10 +213,8 @@ def combine_availabilities_and_static_data():
             car_park_basement=True if carpark['car_park_basement'] == 'Y' else False
         )
 
-        carparks[carpark['car_park_no']] = cp
-
     for carpark in carpark_static_lta:
-        cp = Carpark(
+        catalogue[carpark['carpark']] = dict(
             id=carpark['carpark'],
             position=None,
             address=carpark['carpark'],
@@ -179,7 +226,20 @@ def combine_availabilities_and_static_data():
             sunday_publicholiday_rate=carpark['sunday_publicholiday_rate']
         )
 
-        carparks[carpark['carpark']] = cp
+    CATALOGUE = (mtimes, catalogue)
+    CATALOGUE_VERSION += 1
+    logger.info(f"Loaded {len(catalogue)} carparks from the static catalogue")
+    return catalogue
+
+
+def combine_availabilities_and_static_data():
+    catalogue = load_catalogue()
+    with open(os.path.join(DATA_FOLDER, "avail/avail_datagov_latest.json")) as f:
+        latest_avail_hdb = json.load(f)['carpark_data']
+    with open(os.path.join(DATA_FOLDER, "avail/avail_lta_latest.json")) as f:
+        latest_avail_lta = json.load(f)
+
+    carparks = {carpark_id: Carpark(**static, catalogue=CATALOGUE_VERSION) for carpark_id, static in catalogue.items()}
 
     for avail in latest_avail_lta:
         carpark_id = avail['CarParkID'] if avail['Agency'] == 'HDB' else avail['Development']
@@ -187,7 +247,8 @@ def combine_availabilities_and_static_data():
             cp = Carpark(
                 id=carpark_id,
                 position=None,
-                address=avail['Development']
+                address=avail['Development'],
+                catalogue=CATALOGUE_VERSION
             )
             carparks[carpark_id] = cp
         else:
@@ -232,10 +293,10 @@ def get_available_carparks(position, radius=3, limit=5):
 
     if position is None or radius is None:
         logger.info("position or radius is None, no filtering is done")
-        result = carparks
+        result = [CarparkResult(carpark) for carpark in carparks]
     else:
-        available_carparks = [carpark for carpark in carparks if haversine(carpark.position.latitude, carpark.position.longitude, position.latitude, position.longitude) < radius]
-        result = sorted(available_carparks, key=lambda x: haversine(x.position.latitude, x.position.longitude, position.latitude, position.longitude))
+        results = [CarparkResult(carpark, haversine(carpark.position.latitude, carpark.position.longitude, position.latitude, position.longitude)) for carpark in carparks]
+        result = sorted([r for r in results if r.distance < radius], key=lambda x: x.distance)
         logger.info(f"{len(result)} carparks are available and within radius of {radius}km")
     if limit:
         return result[:min(limit, len(result))]
@@ -5,10 +5,11 @@ from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove,
                       KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup, ChatAction)
 from telegram.ext import (Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters)
 import logging
-from availability import get_available_carparks_page, fetch_carpark_avail_all, retrieve_carpark_by_id, gmaps_search_to_latlon, Position, Page, NoCarparksFoundError
-from utils import haversine
+from availability import get_available_carparks_page, retrieve_carpark_by_id, gmaps_search_to_latlon, Position, Page, NoCarparksFoundError
+from areas import get_neighbouring_areas, get_area_summary
+from scheduler import RefreshScheduler
 from secret import TELEGRAM_TOKEN
-from config import PAGE_SIZE, DISTANCE_RADIUS_KM
+from config import PAGE_SIZE, DISTANCE_RADIUS_KM, AREA_CELL_SIZES_M, AREA_QUERY_CELL_SIZE_M
 
 
 logging.basicConfig(
@@ -16,6 +17,13 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 car_emoji = "🚗"
+map_emoji = "🗺"
+scheduler = None
+# carpark id -> (version, rendered text), see cached_render
+carpark_static_cache = {}
+carpark_lots_cache = {}
+carpark_details_cache = {}
+carpark_static_details_cache = {}
 footnote = "✌🏻 This bot is made by Lingyi. Any bugs or suggestions please submit an issue or pull request on [Github](https://github.com/lingxz/findmeparking)."
 
 
@@ -43,7 +51,7 @@ def start(bot, update):
 
 def help(bot, update):
     update.message.reply_markdown(
-        f"Send me your location to start finding carparks near you or use /find to find carparks near a specific place, e.g. /find city square mall\n\n{footnote}",
+        f"Send me your location to start finding carparks near you or use /find to find carparks near a specific place, e.g. /find city square mall. Use /areas to see which direction has the most free lots, e.g. /areas orchard\n\n{footnote}",
         disable_web_page_preview=True)
 
 
@@ -51,32 +59,51 @@ def error(bot, update, error):
     logger.warn('Update "%s" caused error "%s"' % (update, error))
 
 
-def format_carpark(carpark, distance=None):
+def cached_render(cache, carpark, version, render):
+    """Return render(carpark), reusing the text from the last call while version is unchanged."""
+    cached = cache.get(carpark.id)
+    if cached is None or cached[0] != version:
+        cached = (version, render(carpark))
+        cache[carpark.id] = cached
+    return cached[1]
+
+
+def render_carpark_static(carpark):
+    location_url = f"https://www.google.com/maps/search/?api=1&query={carpark.position.latitude},{carpark.position.longitude}"
+    return f"Carpark ID: [{carpark.id}]({location_url}) | Address: {carpark.address}"
+
+
+def render_carpark_lots(carpark):
     total_lots = carpark.total_lots if carpark.total_lots not in (
         0, None) else "??"
-    location_url = f"https://www.google.com/maps/search/?api=1&query={carpark.position.latitude},{carpark.position.longitude}"
-    result = f"Carpark ID: [{carpark.id}]({location_url}) | Address: {carpark.address} | Lots left: {carpark.available_lots}/{total_lots}"
+    return f"Lots left: {carpark.available_lots}/{total_lots}"
+
+
+def format_carpark(carpark, distance=None):
+    # LTA carparks get their position from the availability data, so it is part of the version
+    result = cached_render(carpark_static_cache, carpark, (carpark.catalogue, carpark.position), render_carpark_static)
+    result += " | " + cached_render(carpark_lots_cache, carpark, carpark.snapshot, render_carpark_lots)
     if distance is None:
         return result
     else:
         return result + f" | Distance from location: {int(distance*1000)}m"
 
 
-def format_reply(carparks, current_pos, current_page, location_str="you"):
+def format_reply(results, current_page, location_str="you"):
     page_str = f"page {current_page.current_page()}/{current_page.total_pages()}"
     if not current_page.has_next():
         page_str = "last page"
 
     reply = car_emoji + f" *Here are the available carparks near {location_str} ({page_str}) :* \n\n"
-    reply += '\n'.join(["*" + str(index + 1) + ".* " + format_carpark(carpark, haversine(current_pos.latitude, current_pos.longitude, carpark.position.latitude, carpark.position.longitude))
-                        for index, carpark in enumerate(carparks)])
+    reply += '\n'.join(["*" + str(index + 1) + ".* " + format_carpark(result.carpark, result.distance)
+                        for index, result in enumerate(results)])
     reply += "\n\n For more details for each carpark press one of the buttons below."
     return reply
 
 
-def get_keyboard(carparks, current_page, lat, lon):
+def get_keyboard(results, current_page, lat, lon):
     carpark_info_kb = [InlineKeyboardButton(
-        str(i + 1), callback_data=cp.id) for i, cp in enumerate(carparks)]
+        str(i + 1), callback_data=result.carpark.id) for i, result in enumerate(results)]
     nested_keyboard = []
     if current_page.has_prev():
         page = current_page.prev_page()
@@ -106,6 +133,7 @@ def nearest_carparks_fuzzy(bot, update, args):
     if len(args) == 0:
         return update.message.reply_text("Please type a location for me to find 😑")
     search_term = ' '.join(args)
+    scheduler.note_query()
     pos, formatted_address = gmaps_search_to_latlon(search_term)
     current_page = Page(0, PAGE_SIZE)
     try:
@@ -116,11 +144,44 @@ def nearest_carparks_fuzzy(bot, update, args):
     reply_markup = InlineKeyboardMarkup(reply_kb)
     location_str = ""
     update.message.reply_markdown(
-        text=format_reply(carparks, pos, current_page, location_str=formatted_address),
+        text=format_reply(carparks, current_page, location_str=formatted_address),
         disable_web_page_preview=True,
         reply_markup=reply_markup)
 
 
+def format_area(summary):
+    if summary.has_complete_total():
+        return f"{summary.available_lots}/{summary.total_lots} lots free in {summary.carparks} carparks"
+    # some carparks do not report a total, so a "/total" would undercount
+    return f"{summary.available_lots} lots free in {summary.carparks} carparks"
+
+
+def format_areas_reply(areas, wider_area, location_str):
+    size_str = f"{AREA_QUERY_CELL_SIZE_M / 1000:g}km"
+    reply = map_emoji + f" *Free lots around {location_str} ({size_str} areas):* \n\n"
+    areas = sorted(areas, key=lambda x: x[1].available_lots, reverse=True)
+    reply += '\n'.join([f"*{direction}*: {format_area(summary)}" for direction, summary in areas])
+    if wider_area is not None:
+        reply += f"\n\n*Wider area ({max(AREA_CELL_SIZES_M) / 1000:g}km)*: {format_area(wider_area)}"
+    reply += "\n\n Use /find to see the carparks near a place."
+    return reply
+
+
+@send_typing_action
+def area_summaries(bot, update, args):
+    if len(args) == 0:
+        return update.message.reply_text("Please type a location for me to find 😑")
+    search_term = ' '.join(args)
+    scheduler.note_query()
+    pos, formatted_address = gmaps_search_to_latlon(search_term)
+    areas = get_neighbouring_areas(pos, AREA_QUERY_CELL_SIZE_M)
+    if len(areas) == 0:
+        return update.message.reply_text(text="Sorry, no carparks found for this location 😞")
+    update.message.reply_markdown(
+        text=format_areas_reply(areas, get_area_summary(pos, max(AREA_CELL_SIZES_M)), formatted_address),
+        disable_web_page_preview=True)
+
+
 def nearest_carparks(bot, update):
     if not update.message:
         is_callback = True
@@ -137,6 +198,7 @@ def nearest_carparks(bot, update):
         logger.info("Location of %s: %f / %f", user.first_name, latitude,
                     longitude)
 
+    scheduler.note_query()
     current_pos = Position(latitude, longitude)
     try:
         carparks, current_page = get_available_carparks_page(current_pos, radius=DISTANCE_RADIUS_KM, limit=None, page=current_page)
@@ -150,13 +212,13 @@ def nearest_carparks(bot, update):
         bot.edit_message_text(
             chat_id=update.callback_query.message.chat_id,
             message_id=update.callback_query.message.message_id,
-            text=format_reply(carparks, current_pos, current_page),
+            text=format_reply(carparks, current_page),
             disable_web_page_preview=True,
             parse_mode=telegram.ParseMode.MARKDOWN,
             reply_markup=reply_markup)
     else:
         update.message.reply_markdown(
-            text=format_reply(carparks, current_pos, current_page),
+            text=format_reply(carparks, current_page),
             disable_web_page_preview=True,
             reply_markup=reply_markup)
 
@@ -165,17 +227,10 @@ def bool_to_string(bool):
     return "yes" if bool else "no"
 
 
-def format_carpark_details(carpark):
-    reply = f"*=== 🚘 Carpark {carpark.id} ===*\n"
-    reply += f"[Google maps link](https://www.google.com/maps/search/?api=1&query={carpark.position.latitude},{carpark.position.longitude})\n"
-    reply += f"*Address*: {carpark.address}\n"
-    total_lots = carpark.total_lots if carpark.total_lots not in (
-        0, None) else "??"
-    reply += f"*Lots left*: {carpark.available_lots}/{total_lots}\n"
+def render_carpark_static_details(carpark):
+    reply = ""
 
     # lta variables
-    if carpark.lta_area:
-        reply += f"*Area*: {carpark.lta_area}\n"
     if carpark.weekdays_rate_1:
         reply += f"*Weekdays rate 1*: {carpark.weekdays_rate_1}\n"
     if carpark.weekdays_rate_2:
@@ -206,9 +261,29 @@ def format_carpark_details(carpark):
     return reply
 
 
+def render_carpark_details(carpark):
+    reply = f"*=== 🚘 Carpark {carpark.id} ===*\n"
+    reply += f"[Google maps link](https://www.google.com/maps/search/?api=1&query={carpark.position.latitude},{carpark.position.longitude})\n"
+    reply += f"*Address*: {carpark.address}\n"
+    total_lots = carpark.total_lots if carpark.total_lots not in (
+        0, None) else "??"
+    reply += f"*Lots left*: {carpark.available_lots}/{total_lots}\n"
+    if carpark.lta_area:
+        reply += f"*Area*: {carpark.lta_area}\n"
+
+    # rates and hdb information only come from the static files
+    reply += cached_render(carpark_static_details_cache, carpark, carpark.catalogue, render_carpark_static_details)
+    return reply
+
+
+def format_carpark_details(carpark):
+    return cached_render(carpark_details_cache, carpark, carpark.snapshot, render_carpark_details)
+
+
 def single_carpark_details(bot, update):
     carpark_id = update.callback_query.data
     logger.info(f"Retrieve single carpark details for carpark id {carpark_id}")
+    scheduler.note_query()
     cp = retrieve_carpark_by_id(carpark_id)
     bot.send_message(
         chat_id=update.callback_query.message.chat_id,
@@ -232,12 +307,14 @@ def handle_callback(bot, update):
 
 
 def main():
+    global scheduler
     updater = Updater(TELEGRAM_TOKEN)
     dp = updater.dispatcher
 
     dp.add_handler(CommandHandler('start', start))
     dp.add_handler(CommandHandler('help', help))
     dp.add_handler(CommandHandler('find', nearest_carparks_fuzzy, pass_args=True))
+    dp.add_handler(CommandHandler('areas', area_summaries, pass_args=True))
     dp.add_handler(CallbackQueryHandler(handle_callback))
 
     location_handler = MessageHandler(
@@ -246,11 +323,12 @@ def main():
 
     dp.add_error_handler(error)
 
+    # fetch the first snapshot before any update can reach a handler
+    scheduler = RefreshScheduler(updater.job_queue)
+    scheduler.start()
+
     updater.start_polling()
     logger.info('----- Bot running -----')
-    j = updater.job_queue
-    j.run_repeating(lambda bot, job: fetch_carpark_avail_all(),
-                    interval=90, first=0)
     updater.idle()
 
 
@@ -1,3 +1,15 @@
 PAGE_SIZE = 5
 DISTANCE_RADIUS_KM = 2
 DATA_FOLDER = "data"
+
+# refresh scheduling, all in seconds
+REFRESH_DEFAULT_INTERVAL = 90  # initial guess of how often each source publishes
+REFRESH_MIN_INTERVAL = 30
+REFRESH_MAX_INTERVAL = 900  # used when nobody has queried recently
+REFRESH_STALE_AFTER = 300  # a query on a snapshot older than this refreshes it first
+DEMAND_WINDOW = 900
+DEMAND_BUSY_QUERIES = 20  # queries within DEMAND_WINDOW at which we poll faster than the source cadence
+
+# area summaries, grid cell sizes in metres on the SVY21 plane, smallest first
+AREA_CELL_SIZES_M = (500, 1000, 2000, 4000)
+AREA_QUERY_CELL_SIZE_M = 1000  # cells compared by /areas, the largest size is reported as the wider area
@@ -0,0 +1,157 @@
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+import availability
+from config import (REFRESH_DEFAULT_INTERVAL, REFRESH_MIN_INTERVAL, REFRESH_MAX_INTERVAL,
+                    REFRESH_STALE_AFTER, DEMAND_WINDOW, DEMAND_BUSY_QUERIES)
+
+logger = logging.getLogger(__name__)
+
+CADENCE_SMOOTHING = 0.3  # weight given to the newest observation in the cadence average
+
+
+@dataclass
+class SourceState:
+    name: str
+    cadence: float = REFRESH_DEFAULT_INTERVAL  # estimated seconds between upstream publishes
+    version: str = None
+    published_at: float = None
+    last_fetch: float = None  # last successful fetch
+    last_attempt: float = None
+    failed: bool = False  # whether the last attempt failed
+    last_change: float = None
+    next_due: float = None
+    job: object = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def observe(self, update, now):
+        """Record a fetch result and update the cadence estimate. Returns whether
+        the source published a new version since the last fetch."""
+        self.last_attempt = now
+        self.failed = update is None
+        if self.failed:
+            return False
+        previous_fetch = self.last_fetch
+        self.last_fetch = now
+        if update.version == self.version:
+            return False
+
+        published_at = update.published_at if update.published_at is not None else now
+        if self.published_at is not None and previous_fetch is not None:
+            delta = published_at - self.published_at
+            if delta > 0:
+                if previous_fetch == self.last_change:
+                    # the previous poll saw a new version too, so we may have skipped some
+                    # and the source publishes at least once per poll gap, likely faster
+                    delta = min(delta, now - previous_fetch) / 2
+                self.learn(delta)
+        self.version = update.version
+        self.published_at = published_at
+        self.last_change = now
+        return True
+
+    def learn(self, delta):
+        # a gap longer than the slowest poll is an upstream outage, not a cadence
+        delta = min(delta, REFRESH_MAX_INTERVAL)
+        self.cadence = (1 - CADENCE_SMOOTHING) * self.cadence + CADENCE_SMOOTHING * delta
+
+    def is_stale(self, now):
+        """Whether a query should refresh this source first. After a failure we
+        wait at least REFRESH_MIN_INTERVAL before letting a query retry."""
+        if self.last_attempt is not None and now - self.last_attempt < REFRESH_MIN_INTERVAL:
+            return False
+        return self.last_fetch is None or now - self.last_fetch > REFRESH_STALE_AFTER
+
+
+class RefreshScheduler:
+    """Polls each availability source at an interval derived from how often it
+    publishes and how many queries we have seen recently."""
+
+    def __init__(self, job_queue, fetchers=None):
+        self.job_queue = job_queue
+        self.fetchers = fetchers or availability.FETCHERS
+        self.sources = {name: SourceState(name) for name in self.fetchers}
+        self.queries = deque()
+        self.lock = threading.RLock()
+
+    def start(self):
+        self.refresh(list(self.sources))
+        for source in self.sources.values():
+            self.schedule(source, self.interval(source))
+
+    def demand(self, now):
+        while self.queries and now - self.queries[0] > DEMAND_WINDOW:
+            self.queries.popleft()
+        return len(self.queries)
+
+    def interval(self, source, now=None):
+        if source.failed:
+            return REFRESH_MIN_INTERVAL
+        now = now or time.time()
+        with self.lock:
+            demand = self.demand(now)
+        if demand == 0:
+            return REFRESH_MAX_INTERVAL
+        interval = source.cadence / 2 if demand >= DEMAND_BUSY_QUERIES else source.cadence
+        return min(REFRESH_MAX_INTERVAL, max(REFRESH_MIN_INTERVAL, interval))
+
+    def schedule(self, source, delay):
+        with self.lock:
+            if source.job is not None:
+                source.job.schedule_removal()
+            source.next_due = time.time() + delay
+            source.job = self.job_queue.run_once(lambda bot, job: self.run(source.name), delay)
+        logger.debug(f"next {source.name} refresh in {int(delay)}s (cadence {int(source.cadence)}s)")
+
+    def run(self, name):
+        source = self.sources[name]
+        with self.lock:
+            source.job = None
+        self.refresh([name])
+        self.schedule(source, self.interval(source))
+
+    def refresh(self, names):
+        """Fetch the given sources and rebuild the carparks once if any of them
+        published new data. Sources already being fetched by another thread are skipped."""
+        changed = []
+        for name in names:
+            source = self.sources[name]
+            if not source.lock.acquire(blocking=False):
+                continue
+            try:
+                try:
+                    update = self.fetchers[name]()
+                except Exception as e:
+                    logger.error(f"Fetching {name} failed: {e}")
+                    update = None
+                if source.observe(update, time.time()):
+                    changed.append(name)
+            finally:
+                source.lock.release()
+        if changed:
+            try:
+                availability.refresh_carparks()
+            except Exception as e:
+                logger.error(f"Rebuilding carparks failed: {e}")
+                for name in changed:
+                    # forget the version so the next fetch rebuilds again
+                    self.sources[name].version = None
+        return changed
+
+    def note_query(self):
+        """Record demand from a user query. Stale sources are refreshed before
+        answering, and sources that were idling are pulled forward."""
+        now = time.time()
+        with self.lock:
+            self.queries.append(now)
+        stale = [name for name, source in self.sources.items() if source.is_stale(now)]
+        if stale:
+            logger.info(f"Snapshot is stale, refreshing {', '.join(stale)} on demand")
+            self.refresh(stale)
+        for source in self.sources.values():
+            interval = self.interval(source, now)
+            if source.next_due is not None and source.next_due - now > interval:
+                last_attempt = source.last_attempt or now
+                self.schedule(source, max(0, last_attempt + interval - now))